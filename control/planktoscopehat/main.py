@@ -12,6 +12,7 @@ import planktoscope.light # Fan HAT LEDs
 import planktoscope.identity
 import planktoscope.uuidName # Note: this is deprecated.
 import planktoscope.display # Fan HAT OLED screen
+import planktoscope.i2c
 from planktoscope.imagernew import mqtt as imagernew
 
 # enqueue=True is necessary so we can log accross modules
@@ -103,12 +104,12 @@ if __name__ == "__main__":
     else:
         imager_thread.start()
 
-    # Starts the light process
-    logger.info("Starting the light control process (step 4/5)")
+    # Starts the light thread
+    logger.info("Starting the light control thread (step 4/5)")
     try:
         light_thread = planktoscope.light.LightProcess(shutdown_event)
     except Exception as e:
-        logger.error("The light control process could not be started")
+        logger.error(f"The light control thread could not be started: {e}")
         light_thread = None
     else:
         light_thread.start()
@@ -139,12 +140,13 @@ if __name__ == "__main__":
         imager_thread.join()
     if light_thread:
         light_thread.join()
+    # The I2C bus is shared by every driver in this process, so we only close it
+    # once they are all stopped
+    planktoscope.i2c.close_bus()
 
     stepper_thread.close()
     if imager_thread:
         imager_thread.close()
-    if light_thread:
-        light_thread.close()
 
     display.stop()
 
@@ -0,0 +1,46 @@
+"""i2c provides a process-wide handle on the Raspberry Pi's I2C bus."""
+
+import contextlib
+import threading
+import typing
+
+import smbus2
+
+# The I2C bus exposed on the GPIO header is /dev/i2c-1
+BUS_NUMBER = 1
+
+_bus: typing.Optional[smbus2.SMBus] = None
+_bus_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def locked_bus() -> typing.Iterator[smbus2.SMBus]:
+    """Give exclusive access to the shared handle on the I2C bus, opening it on first use.
+
+    smbus2 selects the target device with an `I2C_SLAVE` ioctl which is stored on the file
+    descriptor, and only then issues the transfer with a separate ioctl. Drivers on different
+    threads could interleave between those two calls and talk to the wrong device, so every
+    transfer on the shared handle must happen inside this context, and drivers must not keep the
+    handle once they leave it.
+
+    Yields:
+        The open I2C bus, locked for the caller until the context exits.
+    """
+    global _bus  # pylint: disable=global-statement
+    with _bus_lock:
+        if _bus is None:
+            _bus = smbus2.SMBus(BUS_NUMBER)
+        yield _bus
+
+
+def close_bus() -> None:
+    """Close the shared handle on the I2C bus, if it is open.
+
+    This must only be called by the owner of the process once no driver uses the bus anymore, e.g.
+    at shutdown. Drivers must not call it.
+    """
+    global _bus  # pylint: disable=global-statement
+    with _bus_lock:
+        if _bus is not None:
+            _bus.close()
+            _bus = None
@@ -5,7 +5,6 @@ import json
 import multiprocessing
 import os
 import threading
-import time
 import typing
 
 import loguru
@@ -95,7 +94,8 @@ class Worker(multiprocessing.Process):
                     self._active_routine = None
 
                 if not self._mqtt.new_message_received():
-                    time.sleep(0.1)
+                    # Waiting on the event lets a shutdown interrupt the wait right away
+                    self._stop_event_loop.wait(timeout=0.1)
                     continue
                 self._handle_new_message()
         finally:
@@ -400,7 +400,7 @@ class _PumpClient:
 
         while not self._stop_receiving_mqtt.is_set():
             if not self._mqtt.new_message_received():
-                time.sleep(0.1)
+                self._stop_receiving_mqtt.wait(timeout=0.1)
                 continue
             if self._mqtt.msg is None or self._mqtt.msg["topic"] != "status/pump":
                 continue
@@ -6,28 +6,70 @@ from loguru import logger
 
 import os, time
 
-# Library for starting processes
-import multiprocessing
+# Library for starting threads
+import threading
 
 # Basic planktoscope libraries
 import planktoscope.mqtt
 
-import RPi.GPIO
-
-import subprocess  # nosec
+# Shared I2C bus for the light module on the fan
+import planktoscope.i2c
 
-# Library to send command over I2C for the light module on the fan
-import smbus2 as smbus
+import RPi.GPIO
 
 import enum
 
 
 logger.info("planktoscope.light is loaded")
 
+# Fixed status messages, encoded once so they can be published as they are
+_STATUS_BAD_ARGS = b'{"status":"Received message did not contain action or settings"}'
+_STATUS_LED1_ON = b'{"status":"Led 1: On"}'
+_STATUS_LED2_ON = b'{"status":"Led 2: On"}'
+_STATUS_LED1_OFF = b'{"status":"Led 1: Off"}'
+_STATUS_LED2_OFF = b'{"status":"Led 2: Off"}'
+_STATUS_BAD_LED = b'{"status":"Error with led number"}'
+_STATUS_LED_ON_REJECT = b'{"status":"Turn off the LED before changing the current"}'
+_STATUS_INVALID_CURRENT = b'{"status":"Invalid current"}'
+_STATUS_BAD_CURRENT = b'{"status":"Current out of range"}'
+_STATUS_CURRENT_ERROR = b'{"status":"Error while setting the current, power cycle your machine"}'
+_STATUS_READY = b'{"status":"Ready"}'
+_STATUS_DEAD = b'{"status":"Dead"}'
+
+# RPi.GPIO only needs to be configured once per process, until it is cleaned up
+_gpio_initialized = False
+
+
+def gpio_setup():
+    global _gpio_initialized
+    if _gpio_initialized:
+        return
+    RPi.GPIO.setwarnings(False)
+    RPi.GPIO.setmode(RPi.GPIO.BCM)
+    _gpio_initialized = True
+
+
+def gpio_cleanup():
+    global _gpio_initialized
+    RPi.GPIO.cleanup()
+    _gpio_initialized = False
+
+
+def _parse_current(value):
+    """Return the current (mA) of a settings message, or None if it isn't an integer
 
-def i2c_update():
-    # Update the I2C Bus in order to really update the LEDs new values
-    subprocess.Popen("i2cdetect -y 1".split(), stdout=subprocess.PIPE)  # nosec
+    Integer strings such as "20" are accepted, but booleans and non-integral
+    numbers are rejected instead of being truncated.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        # This also rejects the Infinity and NaN values accepted by json.loads
+        return int(value) if value.is_integer() else None
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
 
 
 class i2c_led:
@@ -47,44 +89,57 @@ class i2c_led:
     DEVICE_ADDRESS = 0x64
     # This constant defines the current (mA) sent to the LED, 10 allows the use of the full ISO scale and results in a voltage of 2.77v
     DEFAULT_CURRENT = 10
+    # Range of torch currents (mA) the LM36011 can deliver
+    MIN_TORCH_CURRENT = 3
+    MAX_TORCH_CURRENT = 376
 
+    # RPi.GPIO drives this pin through the memory-mapped /dev/gpiomem registers
+    # rather than sysfs, and output_to_led1/2 skip writes that change nothing
     LED_selectPin = 18
 
+    # Bits of the flags register, with the attribute they are decoded to and
+    # the warning to log when they are asserted
+    _FLAG_TABLE = (
+        (0b1, "flash_timeout", "Flag flash_timeout asserted"),
+        (0b10, "UVLO", "Flag UVLO asserted"),
+        (0b100, "thermal_shutdown", "Flag thermal_shutdown asserted"),
+        (0b1000, "thermal_scale", "Flag thermal_scale asserted"),
+        (0b100000, "VLED_short", "Flag VLED_Short asserted"),
+        (0b1000000, "IVFM", "Flag IVFM asserted"),
+    )
+
     def __init__(self):
-        self.VLED_short = False
-        self.thermal_scale = False
-        self.thermal_shutdown = False
-        self.UVLO = False
-        self.flash_timeout = False
-        self.IVFM = False
-        RPi.GPIO.setwarnings(False)
-        RPi.GPIO.setmode(RPi.GPIO.BCM)
+        self._clear_flags()
+        gpio_setup()
         RPi.GPIO.setup(self.LED_selectPin, RPi.GPIO.OUT)
+        # LED currently driven by the select pin, None until it is first set
+        self._selected_led = None
         self.output_to_led1()
         self.on = False
         try:
             self.force_reset()
             if self.get_flags():
                 logger.error("Flags raised in the LED Module, clearing now")
-                self.VLED_short = False
-                self.thermal_scale = False
-                self.thermal_shutdown = False
-                self.UVLO = False
-                self.flash_timeout = False
-                self.IVFM = False
+                self._clear_flags()
             led_id = self.get_id()
         except (OSError, Exception) as e:
             logger.exception(f"Error with the LED control module, {e}")
             raise
-        logger.debug(f"LED module id is {led_id}")
+        logger.debug("LED module id is {}", led_id)
 
     def output_to_led1(self):
+        if self._selected_led == 1:
+            return
         logger.debug("Switching output to LED 1")
         RPi.GPIO.output(self.LED_selectPin, RPi.GPIO.HIGH)
+        self._selected_led = 1
 
     def output_to_led2(self):
+        if self._selected_led == 2:
+            return
         logger.debug("Switching output to LED 2")
         RPi.GPIO.output(self.LED_selectPin, RPi.GPIO.LOW)
+        self._selected_led = 2
 
     def get_id(self):
         led_id = self._read_byte(self.Register.id_reset)
@@ -94,6 +149,9 @@ class i2c_led:
     def get_state(self):
         return self.on
 
+    def get_selected_led(self):
+        return self._selected_led
+
     def activate_torch_ramp(self):
         logger.debug("Activating the torch ramp")
         reg = self._read_byte(self.Register.configuration)
@@ -112,34 +170,33 @@ class i2c_led:
 
     def get_flags(self):
         flags = self._read_byte(self.Register.flags)
-        self.flash_timeout = bool(flags & 0b1)
-        self.UVLO = bool(flags & 0b10)
-        self.thermal_shutdown = bool(flags & 0b100)
-        self.thermal_scale = bool(flags & 0b1000)
-        self.VLED_short = bool(flags & 0b100000)
-        self.IVFM = bool(flags & 0b1000000)
-        if self.VLED_short:
-            logger.warning("Flag VLED_Short asserted")
-        if self.thermal_scale:
-            logger.warning("Flag thermal_scale asserted")
-        if self.thermal_shutdown:
-            logger.warning("Flag thermal_shutdown asserted")
-        if self.UVLO:
-            logger.warning("Flag UVLO asserted")
-        if self.flash_timeout:
-            logger.warning("Flag flash_timeout asserted")
-        if self.IVFM:
-            logger.warning("Flag IVFM asserted")
+        return self._decode_flags(flags)
+
+    def _decode_flags(self, flags):
+        for mask, attribute, message in self._FLAG_TABLE:
+            asserted = bool(flags & mask)
+            setattr(self, attribute, asserted)
+            if asserted:
+                logger.warning(message)
         return flags
 
+    def _clear_flags(self):
+        for _, attribute, _ in self._FLAG_TABLE:
+            setattr(self, attribute, False)
+
     def set_torch_current(self, current):
         # From 3 to 376mA
         # Curve is not linear for some reason, but this is close enough
-        if current > 376:
-            raise ValueError("the chosen current is too high, max value is 376mA")
+        if current > self.MAX_TORCH_CURRENT:
+            raise ValueError(
+                f"the chosen current is too high, max value is {self.MAX_TORCH_CURRENT}mA"
+            )
         value = int(current * 0.34)
+        # The message is only formatted by loguru if a sink accepts debug logs
         logger.debug(
-            f"Setting torch current to {current}mA, or integer {value} in the register"
+            "Setting torch current to {}mA, or integer {} in the register",
+            current,
+            value,
         )
         try:
             self._write_byte(self.Register.torch, value)
@@ -150,8 +207,9 @@ class i2c_led:
     def set_flash_current(self, current):
         # From 11 to 1500mA
         # Curve is not linear for some reason, but this is close enough
-        value = int(current * 0.085)
-        logger.debug(f"Setting flash current to {value}")
+        # 87/1024 is within one register step of 0.085 over the whole range
+        value = (int(current) * 87) >> 10
+        logger.debug("Setting flash current to {}", value)
         self._write_byte(self.Register.flash, value)
 
     def activate_torch(self):
@@ -162,21 +220,25 @@ class i2c_led:
     def deactivate_torch(self):
         logger.debug("Deactivate torch")
         self._write_byte(self.Register.enable, 0b00)
-        self.off = False
+        self.on = False
 
+    # The I2C bus stays open for the whole process instead of being reopened on
+    # every register access. It is shared with other drivers, so each access
+    # locks it, and it is closed by the main script and not here
     def _write_byte(self, address, data):
-        with smbus.SMBus(1) as bus:
+        with planktoscope.i2c.locked_bus() as bus:
             bus.write_byte_data(self.DEVICE_ADDRESS, address, data)
 
     def _read_byte(self, address):
-        with smbus.SMBus(1) as bus:
-            b = bus.read_byte_data(self.DEVICE_ADDRESS, address)
-        return b
+        # The SMBus "read byte data" transfer is already a single ioctl, which the
+        # adapter issues as the register write and a repeated START for the read
+        with planktoscope.i2c.locked_bus() as bus:
+            return bus.read_byte_data(self.DEVICE_ADDRESS, address)
 
 
 class pwm_led:
     def __init__(self, led):
-        RPi.GPIO.setmode(RPi.GPIO.BCM)
+        gpio_setup()
         self.led = led
         if self.led == 0:
             RPi.GPIO.setup(led0Pin, RPi.GPIO.OUT)
@@ -221,8 +283,14 @@ class pwm_led:
 ################################################################################
 # Main Segmenter class
 ################################################################################
-class LightProcess(multiprocessing.Process):
-    """This class contains the main definitions for the light of the PlanktoScope"""
+# The light only waits on I2C and MQTT, so it runs as a thread of the main
+# process instead of paying for a whole process of its own
+class LightProcess(threading.Thread):
+    """This class contains the main definitions for the light of the PlanktoScope
+
+    It runs as a thread of the main process, so the RPi.GPIO cleanup done when
+    it shuts down applies to the whole main process.
+    """
 
     def __init__(self, event):
         """Initialize the Light class
@@ -236,10 +304,14 @@ class LightProcess(multiprocessing.Process):
 
         self.stop_event = event
         self.light_client = None
+        # Handler and status messages for LED 1 and LED 2 of each action
+        self._actions = {
+            "on": (self.led_on, (_STATUS_LED1_ON, _STATUS_LED2_ON)),
+            "off": (self.led_off, (_STATUS_LED1_OFF, _STATUS_LED2_OFF)),
+        }
         try:
             self.led = i2c_led()
             self.led.set_torch_current(self.led.DEFAULT_CURRENT)
-            self.led.output_to_led1()
             self.led.activate_torch_ramp()
             self.led.activate_torch()
             time.sleep(0.5)
@@ -257,15 +329,30 @@ class LightProcess(multiprocessing.Process):
             logger.success("planktoscope.light is initialised and ready to go!")
 
     def led_off(self, led):
+        """Turn the torch off
+
+        Returns:
+            bool: False if the torch was already off and nothing was done
+        """
+        if not self.led.get_state():
+            return False
         if led == 0:
             logger.debug("Turning led 1 off")
         elif led == 1:
             logger.debug("Turning led 2 off")
         self.led.deactivate_torch()
+        return True
 
     def led_on(self, led):
+        """Turn the torch on for the given led
+
+        Returns:
+            bool: False if this led was already on and nothing was done
+        """
         if led not in [0, 1]:
             raise ValueError("Led number is wrong")
+        if self.led.get_state() and self.led.get_selected_led() == led + 1:
+            return False
         if led == 0:
             logger.debug("Turning led 1 on")
             self.led.output_to_led1()
@@ -273,95 +360,92 @@ class LightProcess(multiprocessing.Process):
             logger.debug("Turning led 2 on")
             self.led.output_to_led2()
         self.led.activate_torch()
+        return True
 
     @logger.catch
-    def treat_message(self):
-        last_message = None
-        if self.light_client.new_message_received():
-            logger.info("We received a new message")
-            last_message = self.light_client.msg["payload"]
-            logger.debug(last_message)
-            self.light_client.read_message()
-            if "action" not in last_message and "settings" not in last_message:
-                logger.error(
-                    f"The received message has the wrong argument {last_message}"
-                )
-                self.light_client.client.publish(
-                    "status/light",
-                    '{"status":"Received message did not contain action or settings"}',
+    def treat_message(self, client, message):
+        """Handle a message received by the MQTT client
+
+        This is called from the MQTT network thread for each received message,
+        possibly before self.light_client is set, so replies go through client.
+
+        Args:
+            client (paho.mqtt.client.Client): client which received the message
+            message (dict): received message, with its topic and decoded payload
+        """
+        logger.info("We received a new message")
+        last_message = message["payload"]
+        logger.debug(last_message)
+        publish = client.publish
+        if not isinstance(last_message, dict):
+            logger.error("The received message has the wrong argument {}", last_message)
+            publish("status/light", _STATUS_BAD_ARGS)
+            return
+        action = last_message.get("action")
+        settings = last_message.get("settings")
+        if action is None and settings is None:
+            logger.error("The received message has the wrong argument {}", last_message)
+            publish("status/light", _STATUS_BAD_ARGS)
+            return
+        if action is not None:
+            # {"action":"on", "led":1}
+            if not isinstance(action, str) or action not in self._actions:
+                logger.warning(
+                    "We did not understand the received request {} - {}",
+                    action,
+                    last_message,
                 )
-                return
-        if last_message:
-            if "action" in last_message:
-                if last_message["action"] == "on":
-                    # {"action":"on", "led":"1"}
-                    logger.info("Turning the light on.")
-                    if "led" not in last_message or last_message["led"] == 1:
-                        self.led_on(0)
-                        self.light_client.client.publish(
-                            "status/light", '{"status":"Led 1: On"}'
-                        )
-                    elif last_message["led"] == 2:
-                        self.led_on(1)
-                        self.light_client.client.publish(
-                            "status/light", '{"status":"Led 2: On"}'
-                        )
-                    else:
-                        self.light_client.client.publish(
-                            "status/light", '{"status":"Error with led number"}'
-                        )
-                elif last_message["action"] == "off":
-                    # {"action":"off", "led":"1"}
-                    logger.info("Turn the light off.")
-                    if "led" not in last_message or last_message["led"] == 1:
-                        self.led_off(0)
-                        self.light_client.client.publish(
-                            "status/light", '{"status":"Led 1: Off"}'
-                        )
-                    elif last_message["led"] == 2:
-                        self.led_off(1)
-                        self.light_client.client.publish(
-                            "status/light", '{"status":"Led 2: Off"}'
-                        )
-                    else:
-                        self.light_client.client.publish(
-                            "status/light", '{"status":"Error with led number"}'
-                        )
+            else:
+                handler, statuses = self._actions[action]
+                led = last_message.get("led", 1)
+                if led in (1, 2):
+                    logger.info("Turning the light {}.", action)
+                    # Repeated commands don't need to touch the hardware nor to
+                    # be acknowledged again
+                    if handler(led - 1):
+                        publish("status/light", statuses[led - 1])
                 else:
-                    logger.warning(
-                        f"We did not understand the received request {action} - {last_message}"
+                    publish("status/light", _STATUS_BAD_LED)
+        if settings is not None:
+            current = settings.get("current") if isinstance(settings, dict) else None
+            if current is not None:
+                # {"settings":{"current":"20"}}
+                if self.led.get_state():
+                    # Led is on, rejecting the change
+                    publish("status/light", _STATUS_LED_ON_REJECT)
+                    return
+                # Reject invalid values before going through the I2C bus
+                current = _parse_current(current)
+                if current is None:
+                    logger.error("The received current is invalid in {}", last_message)
+                    publish("status/light", _STATUS_INVALID_CURRENT)
+                    return
+                if not (
+                    self.led.MIN_TORCH_CURRENT <= current <= self.led.MAX_TORCH_CURRENT
+                ):
+                    logger.error(
+                        "The received current is out of range in {}", last_message
                     )
-            if "settings" in last_message:
-                if "current" in last_message["settings"]:
-                    # {"settings":{"current":"20"}}
-                    current = last_message["settings"]["current"]
-                    if self.led.get_state():
-                        # Led is on, rejecting the change
-                        self.light_client.client.publish(
-                            "status/light",
-                            '{"status":"Turn off the LED before changing the current"}',
-                        )
-                        return
-                    logger.info(f"Switching the LED current to {current}mA")
-                    try:
-                        self.led.set_torch_current(current)
-                    except:
-                        self.light_client.client.publish(
-                            "status/light",
-                            '{"status":"Error while setting the current, power cycle your machine"}',
-                        )
-                    else:
-                        self.light_client.client.publish(
-                            "status/light", f'{{"status":"Current set to {current}mA"}}'
-                        )
+                    publish("status/light", _STATUS_BAD_CURRENT)
+                    return
+                logger.info("Switching the LED current to {}mA", current)
+                try:
+                    self.led.set_torch_current(current)
+                except OSError:
+                    publish("status/light", _STATUS_CURRENT_ERROR)
                 else:
-                    logger.warning(
-                        f"We did not understand the received settings request in {last_message}"
-                    )
-                    self.light_client.client.publish(
-                        "status/light",
-                        f'{{"status":"Settings request not understood in {last_message}"}}',
+                    publish(
+                        "status/light", f'{{"status":"Current set to {current}mA"}}'
                     )
+            else:
+                logger.warning(
+                    "We did not understand the received settings request in {}",
+                    last_message,
+                )
+                publish(
+                    "status/light",
+                    f'{{"status":"Settings request not understood in {last_message}"}}',
+                )
 
     ################################################################################
     # While loop for capturing commands from Node-RED
@@ -375,28 +459,31 @@ class LightProcess(multiprocessing.Process):
 
         # MQTT Service connection
         self.light_client = planktoscope.mqtt.MQTT_Client(
-            topic="light", name="light_client"
+            topic="light", name="light_client", callback=self.treat_message
         )
 
         # Publish the status "Ready" to via MQTT to Node-RED
-        self.light_client.client.publish("status/light", '{"status":"Ready"}')
+        self.light_client.client.publish("status/light", _STATUS_READY)
 
         logger.success("Light module is READY!")
 
-        # This is the loop
-        while not self.stop_event.is_set():
-            self.treat_message()
-            time.sleep(0.1)
+        # Messages are handled by the MQTT network thread as they arrive, so we
+        # only have to wait for the shutdown signal here
+        self.stop_event.wait()
 
-        logger.info("Shutting down the light process")
+        logger.info("Shutting down the light thread")
+        # Stop the network thread first so no message is handled during cleanup
+        self.light_client.shutdown()
         self.led.deactivate_torch()
         self.led.set_torch_current(1)
         self.led.set_flash_current(1)
         self.led.get_flags()
-        RPi.GPIO.cleanup()
-        self.light_client.client.publish("status/light", '{"status":"Dead"}')
-        self.light_client.shutdown()
-        logger.success("Light process shut down! See you!")
+        # This releases every GPIO channel of the main process. It is only safe
+        # because nothing else in it claims GPIO channels: the display is driven
+        # over I2C without a reset pin
+        gpio_cleanup()
+        self.light_client.client.publish("status/light", _STATUS_DEAD)
+        logger.success("Light thread shut down! See you!")
 
 
 # This is called if this script is launched directly
@@ -415,4 +502,5 @@ if __name__ == "__main__":
     led.set_torch_current(1)
     led.set_flash_current(1)
     led.get_flags()
-    RPi.GPIO.cleanup()
+    planktoscope.i2c.close_bus()
+    gpio_cleanup()
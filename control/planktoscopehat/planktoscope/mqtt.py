@@ -53,6 +53,7 @@
 # We can use collections.deque https://docs.python.org/3/library/collections.html#collections.deque
 import paho.mqtt.client as mqtt
 import json
+import socket
 
 # Logger library compatible with multiprocessing
 from loguru import logger
@@ -65,13 +66,22 @@ class MQTT_Client:
 
     Do not forget to include the wildcards in the topic
     when creating this object
+
+    If a callback is given, it is called from the network thread with the
+    paho client and each received message instead of raising the new message
+    flag, so the owner does not need to poll new_message_received(). It can be
+    called before this object is returned, so it must only use the client it
+    is given to publish
     """
 
-    def __init__(self, topic, server="127.0.0.1", port=1883, name="client"):
+    def __init__(
+        self, topic, server="127.0.0.1", port=1883, name="client", callback=None
+    ):
         # Declare the global variables command and args
         self.args = ""
         self.__new_message = False
         self.msg = None
+        self.callback = callback
 
         # MQTT Client functions definition
         self.client = mqtt.Client()
@@ -87,6 +97,7 @@ class MQTT_Client:
         logger.info(f"trying to connect to {self.server}:{self.port}")
         # TODO #104 add try: except ConnectionRefusedError: block here
         # This is a symptom that Mosquitto may have failed to start
+        self.client.on_socket_open = self.on_socket_open
         self.client.connect(self.server, self.port, 60)
         self.client.on_connect = self.on_connect
         self.client.on_subscribe = self.on_subscribe
@@ -98,6 +109,12 @@ class MQTT_Client:
     # MQTT core functions
     ################################################################################
 
+    @logger.catch
+    def on_socket_open(self, client, userdata, sock):
+        # Our messages are small and latency-sensitive, so we don't want Nagle's
+        # algorithm to hold them back while waiting for the previous ACK
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
     @logger.catch
     # Run this function in order to connect to the client (Node-RED)
     def on_connect(self, client, userdata, flags, rc):
@@ -135,6 +152,9 @@ class MQTT_Client:
         logger.debug(f"args are {self.args}")
         self.msg = {"topic": msg.topic, "payload": self.args}
         logger.debug(f"msg is {self.msg}")
+        if self.callback is not None:
+            self.callback(client, self.msg)
+            return
         self.__new_message = True
 
     @logger.catch